@@ -4,9 +4,9 @@ from workflow import run_workflow  # <-- your workflow logic lives here
 
 port = int(os.environ.get('PORT', 4000))
 app = Flask(__name__, static_folder="static", template_folder="templates")
-
-UPLOAD_FOLDER = "uploads"
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+# Caps the whole multipart request body: Whisper's 25 MB file limit plus
+# 1 MB of headroom for the form fields and boundaries around the recording
+app.config["MAX_CONTENT_LENGTH"] = 26 * 1024 * 1024
 
 
 # -------------------------
@@ -26,17 +26,24 @@ def upload_audio():
         return jsonify({"error": "No file uploaded"}), 400
 
     file = request.files["audio_data"]
-    save_path = os.path.join("uploads", file.filename)
-    os.makedirs("uploads", exist_ok=True)
-    file.save(save_path)
+    # Hand Werkzeug's upload stream (in memory for small files, its own temp
+    # file for larger ones) straight to the Whisper upload without copying it.
+    # The filename tells the API the audio format.
+    audio = (file.filename, file.stream)
 
     try:
-        result = run_workflow(save_path)  # call your workflow
+        result = run_workflow(audio)  # call your workflow
         return jsonify(result)  # return JSON directly
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
+@app.errorhandler(413)
+def upload_too_large(e):
+    # Keep /upload errors JSON; the frontend always calls response.json()
+    return jsonify({"error": "Recording is too large (Whisper accepts up to 25 MB)"}), 413
+
+
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=port)
 
@@ -1,6 +1,8 @@
 import re
+import numpy as np
 import pandas as pd
-from rapidfuzz import process, fuzz
+from rapidfuzz import process, utils
+from rapidfuzz.fuzz import token_set_ratio
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 from datetime import datetime
@@ -10,44 +12,167 @@ import os
 import io
 import csv
 import json
+import time
+import tempfile
+import copy
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 # -----------------------------
 # CONFIG
 # -----------------------------
 REFERENCE_SHEET_ID = open("reference_sheet.txt").read().strip()
 TIMESHEET_SHEET_ID = open("timesheet.txt").read().strip()
+REFERENCE_TTL = 300  # seconds before the reference sheet is fetched again
+REFERENCE_CACHE_PATH = os.path.join(".cache", f"reference_{REFERENCE_SHEET_ID}.json")
+EXTRACT_CACHE_SIZE = 128  # transcripts whose GPT extraction is kept in memory
+MATCH_CACHE_SIZE = 4096  # fuzzy-matched task strings remembered per reference load
 load_dotenv()
 
+# process.cdist only stays in native code for scorers carrying rapidfuzz's C
+# scorer capsule; the pure-Python fallback build calls back into Python per pair.
+if not hasattr(token_set_ratio, "_RF_Scorer"):
+    print("⚠️ rapidfuzz C extension not available, chargecode matching will be slow")
+
+_SHEETS_CLIENT = None
+_TIMESHEET = None
+_OPENAI = None
+_REF_CACHE = {"ref": None, "ts": 0}
+_EXTRACT_CACHE = OrderedDict()
+_EXTRACT_CACHE_LOCK = threading.Lock()
+
 # -----------------------------
 # STEP 1: CONNECT TO GOOGLE SHEETS
 # -----------------------------
 def connect_sheets():
-    scope = ["https://spreadsheets.google.com/feeds",
-             "https://www.googleapis.com/auth/drive"]
-    creds = ServiceAccountCredentials.from_json_keyfile_name("service_account.json", scope)
-    client = gspread.authorize(creds)
-    return client
+    global _SHEETS_CLIENT
+    if _SHEETS_CLIENT is None:
+        scope = ["https://spreadsheets.google.com/feeds",
+                 "https://www.googleapis.com/auth/drive"]
+        creds = ServiceAccountCredentials.from_json_keyfile_name("service_account.json", scope)
+        _SHEETS_CLIENT = gspread.authorize(creds)
+    return _SHEETS_CLIENT
 
 # -----------------------------
 # STEP 2: LOAD REFERENCE DATA
 # -----------------------------
+def build_reference(data):
+    """
+    Turn the reference sheet (DataFrame with columns "Description" and
+    "WBS element") into the plain lists map_to_chargecodes works on:
+      desc:  Description strings
+      norm:  the same run through rapidfuzz's default_process
+      wbs:   WBS element per row
+      exact: normalised description -> row position (first row wins)
+      memo:  normalised task -> (row position, score) from earlier fuzzy matches
+    """
+    desc = data["Description"].fillna("").astype(str).tolist()
+    return _index_reference(desc, data["WBS element"].tolist())
+
+
+def _index_reference(desc, wbs):
+    norm = [utils.default_process(s) for s in desc]
+
+    exact = {}
+    for pos, n in enumerate(norm):
+        if n:
+            exact.setdefault(n, pos)
+
+    return {
+        "desc": desc,
+        "norm": norm,
+        "wbs": wbs,
+        "exact": exact,
+        "memo": {},
+        }
+
+
+def _cache_reference(ref, ts):
+    _REF_CACHE["ref"] = ref
+    _REF_CACHE["ts"] = ts
+
+
+def _load_reference_from_disk():
+    # Any unreadable, partial or unexpected file is just a cache miss
+    try:
+        with open(REFERENCE_CACHE_PATH, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+        desc, wbs = cached["desc"], cached["wbs"]
+        if not (isinstance(desc, list) and isinstance(wbs, list) and len(desc) == len(wbs)):
+            return
+        _cache_reference(_index_reference([str(d) for d in desc], wbs), float(cached["ts"]))
+    except Exception:
+        return
+
+
+def _save_reference_to_disk(ref, ts):
+    # Write to a temp file and rename it into place, so concurrent refreshes
+    # never leave a half-written cache behind.
+    cache_dir = os.path.dirname(REFERENCE_CACHE_PATH)
+    tmp_path = None
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=cache_dir,
+                                         suffix=".tmp", delete=False) as f:
+            tmp_path = f.name
+            json.dump({"ts": ts, "desc": ref["desc"], "wbs": ref["wbs"]}, f)
+        os.replace(tmp_path, REFERENCE_CACHE_PATH)
+    except (OSError, TypeError, ValueError):
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
 def load_reference(client):
+    """
+    Return the reference sheet as built by build_reference, refetching it
+    from Google Sheets at most once every REFERENCE_TTL seconds. The last
+    fetch is also saved to REFERENCE_CACHE_PATH (one file per sheet id) so a
+    restarted process doesn't have to hit the API.
+    """
+    if _REF_CACHE["ref"] is None:
+        _load_reference_from_disk()
+    if _REF_CACHE["ref"] is not None and time.time() - _REF_CACHE["ts"] < REFERENCE_TTL:
+        return _REF_CACHE["ref"]
+
     sheet = client.open_by_key(REFERENCE_SHEET_ID).sheet1
-    data = pd.DataFrame(sheet.get_all_records())
-    return data
+    ref = build_reference(pd.DataFrame(sheet.get_all_records()))
+    ts = time.time()
+    _cache_reference(ref, ts)
+    _save_reference_to_disk(ref, ts)
+
+    return ref
 
 # -----------------------------
 # STEP 3: TRANSCRIBE VOICE NOTE
 # -----------------------------
-def transcribe_audio(file_path: str) -> str:
+def openai_client():
+    # One client per process so its HTTP connection pool (and the TLS session
+    # to api.openai.com) is reused across requests.
+    global _OPENAI
+    if _OPENAI is None:
+        _OPENAI = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), timeout=30.0, max_retries=2)
+    return _OPENAI
+
 
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+def transcribe_audio(audio) -> str:
+    """
+    audio: path to the recording, or anything the OpenAI SDK accepts as a
+    file, e.g. a (filename, binary stream) tuple where the filename carries
+    the audio format's extension.
+    """
 
-    with open(file_path, "rb") as audio_file:
-        transcription = client.audio.transcriptions.create(
-                model="whisper-1",   # or "whisper-1"
-                file=audio_file
-                )
+    if isinstance(audio, (str, os.PathLike)):
+        with open(audio, "rb") as audio_file:
+            return transcribe_audio(audio_file)
+
+    client = openai_client()
+
+    transcription = client.audio.transcriptions.create(
+            model="whisper-1",   # or "whisper-1"
+            file=audio
+            )
     return transcription.text
 
 def extract_tasks(natural_text: str, model: str = "gpt-4o-mini"):
@@ -61,8 +186,17 @@ def extract_tasks(natural_text: str, model: str = "gpt-4o-mini"):
       model : str
           OpenAI model to use (default: gpt-4o-mini).
 
+      Results are memoised per (model, text) so re-submitting the same
+      transcript doesn't cost another completion. Callers always get their
+      own copy, so mutating the returned tasks can't alter the cache.
       """
 
+    key = hashlib.sha256(f"{model}\0{natural_text}".encode("utf-8")).hexdigest()
+    with _EXTRACT_CACHE_LOCK:
+        if key in _EXTRACT_CACHE:
+            _EXTRACT_CACHE.move_to_end(key)
+            return copy.deepcopy(_EXTRACT_CACHE[key])
+
     system_prompt = """You are an assistant that extracts structured time log data.
   Return ONLY valid JSON: a dictionary containing two keys:
   1 'extracted_date': date mentioned by the user for log entry
@@ -83,7 +217,7 @@ def extract_tasks(natural_text: str, model: str = "gpt-4o-mini"):
 
     user_prompt = f"Extract the tasks and hours from this text:\n\n{natural_text}"
 
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    client = openai_client().with_options(timeout=10, max_retries=1)
 
     response = client.chat.completions.create(
               model=model,
@@ -98,64 +232,104 @@ def extract_tasks(natural_text: str, model: str = "gpt-4o-mini"):
     except json.JSONDecodeError:
         raise ValueError(f"Model did not return valid JSON:\n{content}")
 
+    extracted = (result['extracted_date'], result['tasks'])
+    with _EXTRACT_CACHE_LOCK:
+        _EXTRACT_CACHE[key] = copy.deepcopy(extracted)
+        if len(_EXTRACT_CACHE) > EXTRACT_CACHE_SIZE:
+            _EXTRACT_CACHE.popitem(last=False)
 
-    return result['extracted_date'], result['tasks']
+    return extracted
 
 # -----------------------------
 # STEP 5: MAP TASKS TO CHARGECODES
 # -----------------------------
-
-def map_to_chargecodes(tasks, date, ref_df):
+def map_to_chargecodes(tasks, date, ref):
     """
     tasks: list of dicts like [{"task": "...", "hours": 2}, ...]
     date: date (kept as-is)
-    ref_df: pandas.DataFrame with columns: "Description", "Note", "WBS element"
+    ref: reference lists as returned by build_reference / load_reference
 
-    Returns: list of mappings with row_number (0-based), row_index (df index label), chargecode_id, score, etc.
+    Returns: list of mappings with date, chargecode_id, hours, matched_with, score.
     """
     mapped = []
-    hours_till_now = 0.0
-
-    choices = ref_df["Description"].tolist()
-
-    for entry in tasks:
-        task = str(entry.get("task", "")).strip()
-        hours = entry.get("hours", 0)
-        # rapidfuzz.process.extractOne returns (match_string, score, index)
-        match_result = process.extractOne(task, choices, scorer=fuzz.token_set_ratio)
-
-        match_str, score, pos = match_result
-
-        # get df row by integer location pos
-        row_label = ref_df.index[pos]           # actual index label (could be non-int)
-        chargecode_id = ref_df.iloc[pos]["WBS element"]
 
+    queries = [utils.default_process(str(entry.get("task", "")).strip()) for entry in tasks]
+
+    # Tasks that are literally a description, or were matched before against
+    # this reference, are resolved without scoring. ref is shared
+    # between request threads, so memo is read with single lookups and is
+    # replaced rather than cleared in place.
+    exact, memo = ref["exact"], ref["memo"]
+    resolved = {}
+    for q in queries:
+        if q in exact:
+            resolved[q] = (exact[q], 100)
+            continue
+        hit = memo.get(q)
+        if hit is not None:
+            resolved[q] = hit
+    misses = [q for q in dict.fromkeys(queries) if q not in resolved]
+
+    if misses:
+        # Score the remaining tasks against every description in one native
+        # call: scores is an (n_misses x n_choices) matrix, best holds the
+        # column of the top match for each task (first one on ties, like
+        # extractOne). Both sides are already normalised, hence processor=None.
+        # argmax runs on the float scores so near-ties aren't decided by
+        # rounding; only the reported score is rounded to uint8.
+        scores = process.cdist(misses, ref["norm"], scorer=token_set_ratio,
+                               processor=None, workers=-1, dtype=np.float32)
+        best = scores.argmax(axis=1)
+        best_scores = np.rint(scores[np.arange(len(misses)), best]).astype(np.uint8)
+        found = dict(zip(misses, zip(best.tolist(), best_scores.tolist())))
+        resolved.update(found)
+
+        if len(memo) + len(found) > MATCH_CACHE_SIZE:
+            ref["memo"] = found
+        else:
+            memo.update(found)
+
+    best = [resolved[q][0] for q in queries]
+    best_scores = [resolved[q][1] for q in queries]
+
+    chargecode_ids = [ref["wbs"][pos] for pos in best]
+    match_strs = [ref["desc"][pos] for pos in best]
+
+    # Scale total hours to 8 hours in a day, truncating to 2 decimals
+    hours = np.array([entry.get("hours", 0) for entry in tasks], dtype=np.float64)
+    hours_till_now = hours.sum()
+
+    if hours_till_now and hours_till_now != 8.0:
+        hours = np.trunc(hours * (8.0 / hours_till_now) * 100) / 100
+
+    for chargecode_id, match_str, score, hrs in zip(chargecode_ids, match_strs, best_scores, hours.tolist()):
         mapped.append({
             "date": date,
             "chargecode_id": chargecode_id,
-            "hours": hours,
+            "hours": hrs,
             "matched_with": match_str,
             "score": score,
             })
 
-        hours_till_now = hours_till_now + hours
-
-    # Scale total hours to 8 hours in a day
-
-    if hours_till_now != 8.0:
-        scaling_factor = 8.0 / hours_till_now
-        for entry in mapped:
-            entry["hours"] = int((entry["hours"] * scaling_factor) * 100) / 100
-
     return mapped
 
 # -----------------------------
 # STEP 6: APPEND TO TIMESHEET
 # -----------------------------
+def open_timesheet(client):
+    global _TIMESHEET
+    if _TIMESHEET is None:
+        _TIMESHEET = client.open_by_key(TIMESHEET_SHEET_ID).sheet1
+    return _TIMESHEET
+
+
 def append_timesheet(client, entries):
-    sheet = client.open_by_key(TIMESHEET_SHEET_ID).sheet1
-    for e in entries:
-        sheet.append_row([e["date"], e["chargecode_id"], e["hours"], e["matched_with"], e["score"]])
+    sheet = open_timesheet(client)
+    rows = [[e["date"], e["chargecode_id"], e["hours"], e["matched_with"], e["score"]] for e in entries]
+    if rows:
+        # One values.append request for the whole day instead of one per row;
+        # RAW like the old append_row, so cells are stored exactly as given
+        sheet.append_rows(rows, value_input_option="RAW")
 
 # -----------------------------
 # MAIN
@@ -164,11 +338,18 @@ def run_workflow(voice_file):
     print("🔄 Starting workflow...")
 
     client = connect_sheets()
-    ref_df = load_reference(client)
 
     print("🎙️ Transcribing audio...")
 
-    transcription = transcribe_audio(voice_file)
+    # Neither the reference sheet fetch nor opening the timesheet depends on
+    # the transcript, so run them while Whisper is busy instead of before it.
+    with ThreadPoolExecutor(max_workers=3) as ex:
+        f_ref = ex.submit(load_reference, client)
+        f_sheet = ex.submit(open_timesheet, client)
+        f_trans = ex.submit(transcribe_audio, voice_file)
+        ref = f_ref.result()
+        f_sheet.result()
+        transcription = f_trans.result()
 
     print("Transcript:", transcription)
 
@@ -180,7 +361,7 @@ def run_workflow(voice_file):
 
     print("🔍 Mapping to chargecodes...")
 
-    mapped_entries = map_to_chargecodes(tasks, extracted_date, ref_df)
+    mapped_entries = map_to_chargecodes(tasks, extracted_date, ref)
     for m in mapped_entries:
         print(f"{m['hours']}h → {m['chargecode_id']} ({m['matched_with']}, score={m['score']})")
 